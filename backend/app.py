@@ -1,16 +1,20 @@
-import base64, io, os, re, json, traceback, pathlib
+import asyncio, os, re, json, threading, time, traceback, pathlib
+from collections import OrderedDict, defaultdict
+from hashlib import blake2b
 from typing import Optional, List, Dict, Any
 
+import ahocorasick
 import fitz  # PyMuPDF
-from PIL import Image
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 
 from fastapi import FastAPI, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import google.generativeai as genai
-from rapidfuzz import process, fuzz
+from rapidfuzz import process, fuzz, utils
 
 # ---------------------------------------------------------------------
 # ENV + MODEL CONFIG
@@ -20,6 +24,8 @@ API_KEY = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
 if not API_KEY:
     raise RuntimeError("Set GOOGLE_API_KEY or GEMINI_API_KEY in .env")
 
+# the SDK caches its (gRPC) client after configure(), so every call below
+# reuses one channel instead of reconnecting per request
 genai.configure(api_key=API_KEY)
 
 # Fastest → slowest fallback
@@ -30,9 +36,21 @@ PREFERRED = [
     "gemini-1.5-flash",
 ]
 
+MODELS_TTL = 300  # seconds
+_models_cache = (0.0, [])
+
+def list_models_cached():
+    """genai.list_models() is a network call; reuse the result for MODELS_TTL."""
+    global _models_cache
+    ts, models = _models_cache
+    if not models or time.time() - ts >= MODELS_TTL:
+        models = list(genai.list_models())
+        _models_cache = (time.time(), models)
+    return models
+
 def pick_model():
     try:
-        models = list(genai.list_models())
+        models = list_models_cached()
         allowed = {}
         for m in models:
             if "generateContent" in getattr(m, "supported_generation_methods", []):
@@ -48,8 +66,8 @@ def pick_model():
 MODEL = pick_model()
 print("\n[MedGPT] Using Gemini:", MODEL, "\n")
 
-def model():
-    return genai.GenerativeModel(MODEL)
+# built once and shared by every endpoint
+MODEL_INSTANCE = genai.GenerativeModel(MODEL)
 
 # ---------------------------------------------------------------------
 # FASTAPI
@@ -72,27 +90,104 @@ except Exception:
 
 ALL_NAMES = []
 ID2ROW = {}
+NAME2IDS = defaultdict(list)  # lowercased name/generic/brand -> row ids (DB order, unique)
+DETECT_NAMES = set()  # NAME2IDS keys worth spotting in free text (no "Generic ..." placeholders)
+
+def _index_name(name_lc, rid):
+    ids = NAME2IDS[name_lc]
+    if rid not in ids:
+        ids.append(rid)
+
+# case-folded copies are computed once here so request paths never call lower()/upper()
 for r in MED_DB:
+    r["_name_lc"] = r["name"].lower()
+    r["_generic_lc"] = r["generic"].lower()
     ID2ROW[r["id"]] = r
     ALL_NAMES.extend([r["name"], r["generic"]])
+    _index_name(r["_name_lc"], r["id"])
+    _index_name(r["_generic_lc"], r["id"])
+    DETECT_NAMES.update((r["_name_lc"], r["_generic_lc"]))
     for b in r.get("brands", []):
+        b["_brand_lc"] = b["brand"].lower()
+        b["_region_uc"] = b.get("region", "").upper()
         ALL_NAMES.append(b["brand"])
+        _index_name(b["_brand_lc"], r["id"])
+        if not b["_brand_lc"].startswith("generic"):
+            DETECT_NAMES.add(b["_brand_lc"])
+
+# row id -> region -> brands sold there (GLOBAL brands merged in, DB order kept);
+# the "GLOBAL" entry doubles as the answer for regions a row has no brands in
+ROW_REGION_BRANDS = {}
+for r in MED_DB:
+    brands = r.get("brands", [])
+    regions = {b["_region_uc"] for b in brands} | {"GLOBAL"}
+    ROW_REGION_BRANDS[r["id"]] = {
+        reg: [b["brand"] for b in brands if b["_region_uc"] in (reg, "GLOBAL")]
+        for reg in regions
+    }
+
+# one automaton over every detectable name; scans text in a single pass
+MED_AUTOMATON = ahocorasick.Automaton()
+for n in DETECT_NAMES:
+    MED_AUTOMATON.add_word(n, n)
+if DETECT_NAMES:
+    MED_AUTOMATON.make_automaton()
+
+# normalized once here instead of on every fuzzy_find call
+ALL_NAMES_PROC = [utils.default_process(n) for n in ALL_NAMES]
+
+FUZZY_CUTOFF = 60  # passed to rapidfuzz so low scores are pruned inside the C++ scan
+FUZZY_LIMIT = 5
+
+FUZZY_FALLBACK = 70  # below this, retry multi-word queries with token_set_ratio
+
+def _extract(q, scorer):
+    return process.extract(q, ALL_NAMES_PROC, scorer=scorer, processor=None,
+                           score_cutoff=FUZZY_CUTOFF, limit=FUZZY_LIMIT)
 
 def fuzzy_find(q):
-    if not q.strip(): return []
-    res = process.extract(q, ALL_NAMES, scorer=fuzz.WRatio, limit=5)
-    return [(x[0], x[1]) for x in res if x[1] >= 60]
+    q = utils.default_process(q)
+    if not q: return []
+    # plain ratio is enough for short drug/brand names and is much cheaper than WRatio
+    res = _extract(q, fuzz.ratio)
+    if " " in q and (not res or res[0][1] < FUZZY_FALLBACK):
+        res = _extract(q, fuzz.token_set_ratio) or res
+    return [(ALL_NAMES[i], score) for _, score, i in res]
+
+def _cdist_top(qs, scorer):
+    """Top FUZZY_LIMIT (name, score) per query from one multi-threaded cdist call."""
+    # float64 so scores are identical to process.extract's in fuzzy_find
+    scores = process.cdist(qs, ALL_NAMES_PROC, scorer=scorer, processor=None,
+                           score_cutoff=FUZZY_CUTOFF, workers=-1, dtype=np.float64)
+    k = min(FUZZY_LIMIT, scores.shape[1])
+    # k-th best score per row, without sorting whole rows
+    kth = -np.partition(-scores, k - 1, axis=1)[:, k - 1]
+    out = []
+    for row, row_kth in zip(scores, kth):
+        # everything tied with the k-th score, ordered (score desc, index asc) like extract
+        cand = np.flatnonzero(row >= max(row_kth, FUZZY_CUTOFF))
+        top = cand[np.lexsort((cand, -row[cand]))][:k]
+        out.append([(ALL_NAMES[j], float(row[j])) for j in top])
+    return out
+
+def fuzzy_find_many(queries):
+    """fuzzy_find for a batch, scoring all queries with batched cdist calls."""
+    qs = [utils.default_process(q) for q in queries]
+    out = [[] for _ in qs]
+    live = [i for i, q in enumerate(qs) if q]
+    if not live or not ALL_NAMES_PROC:
+        return out
+    for i, res in zip(live, _cdist_top([qs[i] for i in live], fuzz.ratio)):
+        out[i] = res
+    # same token_set_ratio fallback as fuzzy_find, batched over the rows that need it
+    weak = [i for i in live if " " in qs[i] and (not out[i] or out[i][0][1] < FUZZY_FALLBACK)]
+    if weak:
+        for i, res in zip(weak, _cdist_top([qs[i] for i in weak], fuzz.token_set_ratio)):
+            out[i] = res or out[i]
+    return out
 
 def rows_for_name(name):
-    n = name.lower()
-    result = []
-    for r in MED_DB:
-        if r["name"].lower() == n or r["generic"].lower() == n:
-            result.append(r)
-        for b in r.get("brands", []):
-            if b["brand"].lower() == n:
-                result.append(r)
-    return list({r["id"]: r for r in result}.values())
+    return [ID2ROW[i] for i in NAME2IDS.get(name.lower(), ())]
 
 # ---------------------------------------------------------------------
 # Schemas
@@ -111,41 +206,131 @@ class BrandMapQAIn(BaseModel):
     region_from: Optional[str] = "IN"
     region_to: Optional[str] = "US"
 
+class MatchNamesIn(BaseModel):
+    names: List[str] = Field(max_length=100)  # bounds the names x ALL_NAMES score matrix
+
 # ---------------------------------------------------------------------
 # Utilities
 # ---------------------------------------------------------------------
+# stdlib re on purpose: RE2's \b is ASCII-only and would split words like "Café";
+# backtracking here is bounded by the {2,30} repeat, so scans stay linear
 MED_REGEX = re.compile(r"\b([A-Za-z][A-Za-z0-9\- ]{2,30})\b")
 
-def detect_meds(text):
-    found = MED_REGEX.findall(text or "")
-    return list({m.strip() for m in found if len(m) > 2})[:10]
+def _detect_meds_regex(text, limit):
+    # stop scanning once `limit` unique names are found
+    seen, out = set(), []
+    for m in MED_REGEX.finditer(text or ""):
+        v = m.group(1).strip()
+        if len(v) > 2 and v not in seen:
+            seen.add(v)
+            out.append(v)
+            if len(out) == limit:
+                break
+    return out
+
+def detect_meds(text, limit=10):
+    """Canonical names of known medicines mentioned in text (regex guess if no DB)."""
+    if not DETECT_NAMES:
+        return _detect_meds_regex(text, limit)
+    low = (text or "").lower()
+    seen, out = set(), []
+    for end, key in MED_AUTOMATON.iter(low):
+        start = end - len(key) + 1
+        # whole words only: "ibuprofen" must not match inside "xibuprofenx"
+        if (start > 0 and low[start - 1].isalnum()) or (end + 1 < len(low) and low[end + 1].isalnum()):
+            continue
+        for rid in NAME2IDS[key]:
+            name = ID2ROW[rid]["name"]
+            if name not in seen:
+                seen.add(name)
+                out.append(name)
+                if len(out) == limit:
+                    return out
+    return out
+
+# LRU of response text keyed on the prompt parts; failures are never cached
+GEN_CACHE_SIZE = 512
+_gen_cache = OrderedDict()
+# run_gemini runs in the threadpool (sync endpoints), run_gemini_async on the loop
+_gen_cache_lock = threading.Lock()
+
+def _cache_key(parts):
+    key = []
+    for p in parts:
+        if isinstance(p, dict):  # inline blob (image / pdf page)
+            key.append((p.get("mime_type"), blake2b(p["data"], digest_size=16).hexdigest()))
+        else:
+            key.append(p)
+    return tuple(key)
+
+def _cache_get(key):
+    with _gen_cache_lock:
+        if key in _gen_cache:
+            _gen_cache.move_to_end(key)
+            return _gen_cache[key]
+    return None
+
+def _cache_put(key, text):
+    with _gen_cache_lock:
+        _gen_cache[key] = text
+        if len(_gen_cache) > GEN_CACHE_SIZE:
+            _gen_cache.popitem(last=False)
 
 def run_gemini(parts):
+    key = _cache_key(parts)
+    hit = _cache_get(key)
+    if hit is not None:
+        return hit
+    try:
+        text = MODEL_INSTANCE.generate_content(parts).text or ""
+    except Exception as e:
+        return f"⚠️ AI failed: {str(e)}"
+    _cache_put(key, text)
+    return text
+
+async def run_gemini_async(parts, generation_config=None):
+    key = _cache_key(parts)
+    if generation_config:
+        key += (orjson.dumps(generation_config, option=orjson.OPT_SORT_KEYS),)
+    hit = _cache_get(key)
+    if hit is not None:
+        return hit
     try:
-        return model().generate_content(parts).text or ""
+        resp = await MODEL_INSTANCE.generate_content_async(parts, generation_config=generation_config)
+        text = resp.text or ""
     except Exception as e:
         return f"⚠️ AI failed: {str(e)}"
+    _cache_put(key, text)
+    return text
+
+MAX_PDF_PAGES = 10  # text past the first pages never survives the max_chars cut
 
 def extract_pdf_text(pdf_bytes, max_chars=5000):
-    out = []
+    out, total = [], 0
     with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-        for p in doc:
-            out.append(p.get_text("text"))
-            if sum(len(x) for x in out) > max_chars:
+        for i in range(min(doc.page_count, MAX_PDF_PAGES)):
+            t = doc.load_page(i).get_text("text")
+            out.append(t)
+            total += len(t) + 1
+            if total >= max_chars:
                 break
     return ("\n".join(out))[:max_chars]
 
+def is_text_sparse(text, min_chars=500, min_alpha=0.5):
+    """True if extracted text is too short or too non-alphabetic to summarize alone."""
+    if len(text) < min_chars:
+        return True
+    return sum(c.isalpha() for c in text) / len(text) < min_alpha
+
 def pdf_first_page_small(pdf_bytes, width=600):
     """Small compressed image to avoid 504 timeouts."""
     try:
         with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
             if doc.page_count == 0: return None
             p = doc[0]
-            pix = p.get_pixmap(matrix=fitz.Matrix(width/72, width/72))
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        buf = io.BytesIO()
-        img.save(buf, format="JPEG", quality=40)
-        return base64.b64encode(buf.getvalue()).decode()
+            pix = p.get_pixmap(matrix=fitz.Matrix(width/72, width/72), alpha=False)
+            # encode straight from the pixmap buffer (no PIL copy)
+            return pix.tobytes(output="jpeg", jpg_quality=40)
     except:
         return None
 
@@ -159,31 +344,60 @@ def home():
 @app.get("/debug/models")
 def dbg():
     out=[]
-    for m in genai.list_models():
+    for m in list_models_cached():
         out.append({"name": m.name, "methods": getattr(m, "supported_generation_methods", [])})
     return {"models": out}
 
 # ASK / CHAT BOT -------------------------------------------------------
+# fallback when the model ignores the JSON instruction: labeled sections
+# (a label line looks like "Simple:", "**Doctor:**", "## Simple:")
+ASK_SECTIONS = re.compile(
+    r"^\W*simple\b[^\w\n:]*:[*_ \t]*(.*?)^\W*doctor\b[^\w\n:]*:[*_ \t]*(.*)",
+    re.I | re.S | re.M,
+)
+
+def split_ask_output(out):
+    """(simple, doctor) from a combined answer; the whole text for both if unparseable."""
+    try:
+        obj = orjson.loads(out[out.index("{"):out.rindex("}") + 1])
+    except ValueError:
+        obj = None
+    if isinstance(obj, dict) and isinstance(obj.get("simple"), str) and isinstance(obj.get("doctor"), str):
+        return obj["simple"], obj["doctor"]
+    m = ASK_SECTIONS.search(out)
+    if m:
+        return m.group(1).strip(), m.group(2).strip()
+    return out, out
+
+ASK_JSON_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "OBJECT",
+        "properties": {"simple": {"type": "STRING"}, "doctor": {"type": "STRING"}},
+        "required": ["simple", "doctor"],
+    },
+}
+
 @app.post("/ask")
-def ask(inp: AskIn):
+async def ask(inp: AskIn):
     profile = inp.profile or {}
 
-    sys_simple = (
-        "You are a safe medical explainer. Explain in simple English. "
-        "Cover uses, side effects, cautions, cheaper generics, and consider user profile. "
-        "End with: 'This is not medical advice.'"
-    )
-    sys_doctor = (
-        "You are a clinician-facing explainer. Cover mechanism, class, doses, AE, "
-        "interactions, monitoring. "
-        "End with: 'This is not medical advice.'"
+    # one call for both audiences: the query + profile are sent once
+    sys = (
+        "You are a safe medical explainer. Answer the query twice and return exactly "
+        "one JSON object with two string keys and nothing else:\n"
+        "\"simple\": explain in simple English. Cover uses, side effects, cautions, "
+        "cheaper generics, and consider user profile.\n"
+        "\"doctor\": clinician-facing. Cover mechanism, class, doses, AE, "
+        "interactions, monitoring.\n"
+        "End each with: 'This is not medical advice.'"
     )
 
     user = f"User Query: {inp.query}\nProfile: {profile}"
 
-    simple = run_gemini([sys_simple, user])
-    doctor = run_gemini([sys_doctor, user])
-    meds = list({*detect_meds(simple), *detect_meds(doctor)})
+    out = await run_gemini_async([sys, user], generation_config=ASK_JSON_CONFIG)
+    simple, doctor = split_ask_output(out)
+    meds = detect_meds(simple + "\n" + doctor)
 
     return {"simple": simple, "doctor": doctor, "detected_medicines": meds}
 
@@ -199,8 +413,10 @@ def profile_qa(inp: ProfileQAIn):
     return {"answer": out}
 
 # BRAND MAP Q&A --------------------------------------------------------
+MAPPING_PROMPT_LIMIT = 20  # rows serialized into the prompt
+
 @app.post("/brandmap_qa")
-def brandmap_qa(inp: BrandMapQAIn):
+async def brandmap_qa(inp: BrandMapQAIn):
     q = inp.question.strip()
     r1 = inp.region_from.upper()
     r2 = inp.region_to.upper()
@@ -214,8 +430,9 @@ def brandmap_qa(inp: BrandMapQAIn):
 
     mapping = []
     for r in rows:
-        from_br = [b["brand"] for b in r.get("brands", []) if b["region"].upper() in (r1, "GLOBAL")]
-        to_br   = [b["brand"] for b in r.get("brands", []) if b["region"].upper() in (r2, "GLOBAL")]
+        by_region = ROW_REGION_BRANDS[r["id"]]
+        from_br = by_region.get(r1, by_region["GLOBAL"])
+        to_br   = by_region.get(r2, by_region["GLOBAL"])
         mapping.append({
             "name": r["name"],
             "generic": r["generic"],
@@ -225,15 +442,36 @@ def brandmap_qa(inp: BrandMapQAIn):
         })
 
     sys = "You are a drug brand mapper. Compare global equivalents safely."
-    user = f"Query: {q}\nFrom: {r1} To: {r2}\nMapping: {json.dumps(mapping)}"
+    payload = orjson.dumps(mapping[:MAPPING_PROMPT_LIMIT]).decode()
+    user = f"Query: {q}\nFrom: {r1} To: {r2}\nMapping: {payload}"
 
-    out = run_gemini([sys, user])
+    out = await run_gemini_async([sys, user])
     return {"mapping": mapping, "answer": out}
 
+# BULK NAME MATCH ------------------------------------------------------
+@app.post("/match_names")
+def match_names(inp: MatchNamesIn):
+    return {"matches": dict(zip(inp.names, fuzzy_find_many(inp.names)))}
+
 # SUMMARIZER -----------------------------------------------------------
+MAX_UPLOAD = 20 * 1024 * 1024
+UPLOAD_CHUNK = 1024 * 1024
+
+async def read_upload(file, limit=MAX_UPLOAD):
+    """Read the upload in chunks; None if it exceeds `limit` bytes."""
+    buf = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK):
+        buf.extend(chunk)
+        if len(buf) > limit:
+            return None
+    return bytes(buf)
+
 @app.post("/summarize")
 async def summarize(file: UploadFile = File(...)):
-    data = await file.read()
+    data = await read_upload(file)
+    if data is None:
+        msg = f"⚠️ File too large (max {MAX_UPLOAD // (1024 * 1024)} MB)."
+        return {"error": "file too large", "summary": msg, "title": file.filename, "detected_medicines": []}
     mime = file.content_type or ""
 
     sys = (
@@ -244,19 +482,22 @@ async def summarize(file: UploadFile = File(...)):
 
     # --------------------- PDF ---------------------
     if mime.startswith("application/pdf"):
-        # small text extract only
-        text = extract_pdf_text(data, max_chars=5000)
+        # small text extract, off the event loop
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(None, extract_pdf_text, data, 5000)
 
-        # ultra-light image embed (optional)
-        img_b64 = pdf_first_page_small(data, width=500)
+        # ultra-light image embed, only for scanned / mostly non-text PDFs
+        img_bytes = None
+        if is_text_sparse(text):
+            img_bytes = await loop.run_in_executor(None, pdf_first_page_small, data, 500)
 
         parts = [sys, "Summarize this PDF report."]
-        if img_b64:
-            parts.append({"mime_type": "image/jpeg", "data": base64.b64decode(img_b64)})
+        if img_bytes:
+            parts.append({"mime_type": "image/jpeg", "data": img_bytes})
 
         parts.append(f"Extracted text:\n{text}")
 
-        summary = run_gemini(parts)
+        summary = await run_gemini_async(parts)
         meds = detect_meds(text + "\n" + summary)
         title = (text.splitlines()[0] if text else "").strip()
 
@@ -265,17 +506,18 @@ async def summarize(file: UploadFile = File(...)):
     # --------------------- IMAGE ---------------------
     if mime.startswith("image/"):
         parts = [sys, "Summarize this medical image report:", {"mime_type": mime, "data": data}]
-        summary = run_gemini(parts)
+        summary = await run_gemini_async(parts)
         meds = detect_meds(summary)
         return {"summary": summary, "title": file.filename, "detected_medicines": meds}
 
     # --------------------- TEXT ---------------------
+    # only the first 5000 chars are used; utf-8 is at most 4 bytes/char
     try:
-        text = data.decode("utf-8", errors="ignore")
+        text = data[:5000 * 4].decode("utf-8", errors="ignore")
     except:
         text = ""
 
     text = text[:5000]
-    summary = run_gemini([sys, text])
+    summary = await run_gemini_async([sys, text])
     meds = detect_meds(text + "\n" + summary)
     return {"summary": summary, "title": file.filename, "detected_medicines": meds}